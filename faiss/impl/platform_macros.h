@@ -174,6 +174,25 @@ inline int __builtin_clzll(uint64_t x) {
 
 // clang-format on
 
+// Function multiversioning for the builds that do not target a specific
+// x86-64 SIMD level (FAISS_OPT_LEVEL=generic): the function is compiled for
+// the x86-64-v4 (AVX512), x86-64-v3 (AVX2, FMA) and baseline ISA levels, and
+// the dynamic loader selects the version that matches the CPU features when
+// the library is loaded (with an ifunc resolver). Dispatching on ISA levels
+// rather than on arch=<cpu> names matters: the latter match the CPU model,
+// so any other CPU would get the baseline version.
+// This requires GCC >= 12 and glibc. It is a no-op in the AVX2 and AVX512
+// builds. The clones cannot be inlined into their callers.
+#if defined(__GNUC__) && !defined(__clang__) && __GNUC__ >= 12 &&          \
+        defined(__x86_64__) && defined(__GLIBC__) && !defined(__AVX2__) && \
+        !defined(SWIG)
+#define FAISS_TARGET_CLONES \
+    __attribute__((         \
+            target_clones("arch=x86-64-v4", "arch=x86-64-v3", "default")))
+#else
+#define FAISS_TARGET_CLONES
+#endif
+
 /*******************************************************
  * BIGENDIAN specific macros
  *******************************************************/
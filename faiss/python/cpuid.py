@@ -0,0 +1,243 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Detection of the x86-64 CPU features with the cpuid instruction.
+
+The instruction is executed from a small machine-code function copied into
+an executable memory page, so that the features can be known before
+importing numpy or any of the compiled SWIG modules. This fails when the
+process is not allowed to allocate executable memory (W^X policies such as
+SELinux deny_execmem or PaX), in which case detect() returns None and the
+caller should fall back to another detection method.
+"""
+
+import ctypes
+import functools
+import mmap
+import platform
+
+
+# void cpuid(uint32_t leaf, uint32_t subleaf, uint32_t regs[4])
+# System V calling convention: leaf in edi, subleaf in esi, regs in rdx
+_CPUID_SYSV = bytes([
+    0x53,                    # push rbx
+    0x89, 0xf8,              # mov eax, edi
+    0x89, 0xf1,              # mov ecx, esi
+    0x49, 0x89, 0xd0,        # mov r8, rdx
+    0x0f, 0xa2,              # cpuid
+    0x41, 0x89, 0x00,        # mov [r8], eax
+    0x41, 0x89, 0x58, 0x04,  # mov [r8 + 4], ebx
+    0x41, 0x89, 0x48, 0x08,  # mov [r8 + 8], ecx
+    0x41, 0x89, 0x50, 0x0c,  # mov [r8 + 12], edx
+    0x5b,                    # pop rbx
+    0xc3,                    # ret
+])
+
+# Windows calling convention: leaf in ecx, subleaf in edx, regs in r8
+_CPUID_WIN64 = bytes([
+    0x53,                    # push rbx
+    0x89, 0xc8,              # mov eax, ecx
+    0x89, 0xd1,              # mov ecx, edx
+    0x0f, 0xa2,              # cpuid
+    0x41, 0x89, 0x00,        # mov [r8], eax
+    0x41, 0x89, 0x58, 0x04,  # mov [r8 + 4], ebx
+    0x41, 0x89, 0x48, 0x08,  # mov [r8 + 8], ecx
+    0x41, 0x89, 0x50, 0x0c,  # mov [r8 + 12], edx
+    0x5b,                    # pop rbx
+    0xc3,                    # ret
+])
+
+# uint64_t xgetbv(uint32_t xcr), xcr in edi (System V) or ecx (Windows)
+_XGETBV_SYSV = bytes([
+    0x89, 0xf9,              # mov ecx, edi
+    0x0f, 0x01, 0xd0,        # xgetbv
+    0x48, 0xc1, 0xe2, 0x20,  # shl rdx, 32
+    0x48, 0x09, 0xd0,        # or rax, rdx
+    0xc3,                    # ret
+])
+
+_XGETBV_WIN64 = _XGETBV_SYSV[2:]
+
+_EAX, _EBX, _ECX, _EDX = range(4)
+
+# (leaf, subleaf, register, bit) for each feature, named as in numpy's
+# __cpu_features__ (numpy does not report PCLMULQDQ, AES, SHA and
+# VPCLMULQDQ), see the Intel SDM vol. 2A, CPUID instruction
+_FEATURE_BITS = {
+    "SSE": (1, 0, _EDX, 25),
+    "PCLMULQDQ": (1, 0, _ECX, 1),
+    "AES": (1, 0, _ECX, 25),
+    "SSE2": (1, 0, _EDX, 26),
+    "SSE3": (1, 0, _ECX, 0),
+    "SSSE3": (1, 0, _ECX, 9),
+    "FMA3": (1, 0, _ECX, 12),
+    "SSE41": (1, 0, _ECX, 19),
+    "SSE42": (1, 0, _ECX, 20),
+    "POPCNT": (1, 0, _ECX, 23),
+    "AVX": (1, 0, _ECX, 28),
+    "F16C": (1, 0, _ECX, 29),
+    "AVX2": (7, 0, _EBX, 5),
+    "AVX512F": (7, 0, _EBX, 16),
+    "AVX512DQ": (7, 0, _EBX, 17),
+    "AVX512IFMA": (7, 0, _EBX, 21),
+    "AVX512CD": (7, 0, _EBX, 28),
+    "SHA": (7, 0, _EBX, 29),
+    "AVX512BW": (7, 0, _EBX, 30),
+    "AVX512VL": (7, 0, _EBX, 31),
+    "AVX512VBMI": (7, 0, _ECX, 1),
+    "AVX512VBMI2": (7, 0, _ECX, 6),
+    "VPCLMULQDQ": (7, 0, _ECX, 10),
+    "AVX512VNNI": (7, 0, _ECX, 11),
+    "AVX512BITALG": (7, 0, _ECX, 12),
+    "AVX512VPOPCNTDQ": (7, 0, _ECX, 14),
+    "AVX512FP16": (7, 0, _EDX, 23),
+    "AVX512BF16": (7, 1, _EAX, 5),
+}
+
+# leaf 1 ecx: the OS uses xsave to save the extended registers on context
+# switches, and xgetbv can be used to check which ones.
+_OSXSAVE_BIT = 27
+
+# XCR0 bits that must be enabled by the OS to use the ymm registers
+# (SSE | AVX state), and the zmm / opmask registers (opmask | ZMM_Hi256 |
+# Hi16_ZMM). Hypervisors may report AVX in cpuid without enabling them, in
+# which case the first AVX instruction raises SIGILL.
+_XCR0_AVX = (1 << 1) | (1 << 2)
+_XCR0_AVX512 = _XCR0_AVX | (1 << 5) | (1 << 6) | (1 << 7)
+
+# features that use the AVX (ymm) or AVX512 (zmm) register state
+_AVX512_STATE_FEATURES = frozenset(
+    f for f in _FEATURE_BITS if f.startswith("AVX512")
+)
+_AVX_STATE_FEATURES = _AVX512_STATE_FEATURES | frozenset(
+    f for f in _FEATURE_BITS
+    if f.startswith("AVX") or f in ("FMA3", "F16C", "VPCLMULQDQ")
+)
+
+
+def is_x86_64():
+    return (platform.machine().lower() in ("x86_64", "amd64") and
+            ctypes.sizeof(ctypes.c_void_p) == 8)
+
+
+class _ExecutableCode:
+    """
+    Machine code copied into a page of executable memory, callable with
+    ctypes. Raises OSError if the page cannot be allocated.
+    """
+
+    def __init__(self, code, functype):
+        size = mmap.PAGESIZE
+        if platform.system() == "Windows":
+            kernel32 = ctypes.windll.kernel32
+            kernel32.VirtualAlloc.restype = ctypes.c_void_p
+            kernel32.VirtualAlloc.argtypes = [
+                ctypes.c_void_p, ctypes.c_size_t,
+                ctypes.c_ulong, ctypes.c_ulong
+            ]
+            MEM_COMMIT_RESERVE = 0x3000
+            PAGE_EXECUTE_READWRITE = 0x40
+            address = kernel32.VirtualAlloc(
+                None, size, MEM_COMMIT_RESERVE, PAGE_EXECUTE_READWRITE)
+            if not address:
+                raise OSError("VirtualAlloc failed")
+            ctypes.memmove(address, code, len(code))
+        else:
+            # keep a reference on the mapping, it is unmapped when collected
+            self.buffer = mmap.mmap(
+                -1, size,
+                flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS,
+                prot=mmap.PROT_READ | mmap.PROT_WRITE | mmap.PROT_EXEC
+            )
+            self.buffer.write(code)
+            address = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+        self.function = functype(address)
+
+
+_Registers = ctypes.c_uint32 * 4
+
+
+@functools.lru_cache(maxsize=1)
+def _cpuid_function():
+    code = _CPUID_WIN64 if platform.system() == "Windows" else _CPUID_SYSV
+    functype = ctypes.CFUNCTYPE(
+        None, ctypes.c_uint32, ctypes.c_uint32, ctypes.POINTER(_Registers))
+    return _ExecutableCode(code, functype)
+
+
+def cpuid(leaf, subleaf=0):
+    """ returns the (eax, ebx, ecx, edx) registers of cpuid(leaf, subleaf) """
+    regs = _Registers()
+    _cpuid_function().function(leaf, subleaf, regs)
+    return tuple(regs)
+
+
+@functools.lru_cache(maxsize=1)
+def _xgetbv_function():
+    code = _XGETBV_WIN64 if platform.system() == "Windows" else _XGETBV_SYSV
+    functype = ctypes.CFUNCTYPE(ctypes.c_uint64, ctypes.c_uint32)
+    return _ExecutableCode(code, functype)
+
+
+def xgetbv(xcr=0):
+    """
+    returns the value of the extended control register `xcr`. Only valid if
+    the OSXSAVE bit of cpuid(1) is set, otherwise this raises SIGILL.
+    """
+    return _xgetbv_function().function(xcr)
+
+
+@functools.lru_cache(maxsize=1)
+def detect():
+    """
+    Returns the set of CPU features detected with cpuid, using the same names
+    as numpy's __cpu_features__, or None if cpuid cannot be executed (not an
+    x86-64 CPU, or no executable memory).
+    """
+    if not is_x86_64():
+        return None
+    try:
+        leaves = {}
+        max_leaf = cpuid(0)[_EAX]
+        for leaf, subleaf, _, _ in _FEATURE_BITS.values():
+            if leaf <= max_leaf and (leaf, subleaf) not in leaves:
+                leaves[(leaf, subleaf)] = cpuid(leaf, subleaf)
+    except (OSError, ValueError, AttributeError):
+        return None
+    # sub-leaves of leaf 7 are only valid up to cpuid(7, 0).eax
+    if (7, 0) in leaves and leaves[(7, 0)][_EAX] < 1:
+        leaves.pop((7, 1), None)
+    features = {
+        name for name, (leaf, subleaf, reg, bit) in _FEATURE_BITS.items()
+        if (leaf, subleaf) in leaves and leaves[(leaf, subleaf)][reg] >> bit & 1
+    }
+    osxsave = bool(leaves[(1, 0)][_ECX] >> _OSXSAVE_BIT & 1)
+    xcr0 = 0
+    if osxsave:
+        try:
+            xcr0 = xgetbv(0)
+        except (OSError, ValueError, AttributeError):
+            return None
+    return _mask_os_state(
+        features, osxsave, xcr0,
+        # macOS enables the AVX512 state lazily, on the first AVX512
+        # instruction of each thread, so XCR0 cannot be trusted there
+        check_avx512_state=platform.system() != "Darwin"
+    )
+
+
+def _mask_os_state(features, osxsave, xcr0, check_avx512_state=True):
+    """
+    Removes from `features` the ones that use register state that the OS
+    does not save, given the OSXSAVE bit of cpuid(1) and the value of XCR0
+    (ignored without OSXSAVE).
+    """
+    features = set(features)
+    if not osxsave or xcr0 & _XCR0_AVX != _XCR0_AVX:
+        features -= _AVX_STATE_FEATURES
+    elif check_avx512_state and xcr0 & _XCR0_AVX512 != _XCR0_AVX512:
+        features -= _AVX512_STATE_FEATURES
+    return frozenset(features)
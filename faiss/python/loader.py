@@ -3,53 +3,276 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from packaging.version import Version
+import ctypes
+import functools
+import importlib
 import platform
+import re
 import subprocess
 import logging
 import os
 
+from . import cpuid
 
-def supported_instruction_sets():
+
+# ELF auxiliary vector entries and aarch64 HWCAP bits, see
+# https://github.com/torvalds/linux/blob/master/arch/arm64/include/uapi/asm/hwcap.h
+_AT_HWCAP = 16
+_AT_HWCAP2 = 26
+_AARCH64_HWCAPS = {
+    "ASIMD": (_AT_HWCAP, 1 << 1),
+    "ASIMDHP": (_AT_HWCAP, 1 << 10),
+    "ASIMDDP": (_AT_HWCAP, 1 << 20),
+    "SVE": (_AT_HWCAP, 1 << 22),
+    "SVE2": (_AT_HWCAP2, 1 << 1),
+    "I8MM": (_AT_HWCAP2, 1 << 13),
+    "BF16": (_AT_HWCAP2, 1 << 14),
+}
+# same features on macOS, see
+# https://developer.apple.com/documentation/kernel/1387446-sysctlbyname/determining_instruction_set_characteristics
+_DARWIN_ARM_SYSCTLS = {
+    "ASIMD": b"hw.optional.AdvSIMD",
+    "ASIMDHP": b"hw.optional.arm.FEAT_FP16",
+    "ASIMDDP": b"hw.optional.arm.FEAT_DotProd",
+    "I8MM": b"hw.optional.arm.FEAT_I8MM",
+    "BF16": b"hw.optional.arm.FEAT_BF16",
+}
+
+
+def _linux_getauxval(types):
     """
-    Returns the set of supported CPU features, see
-    https://github.com/numpy/numpy/blob/master/numpy/core/src/common/npy_cpu_features.h
-    for the list of features that this set may contain per architecture.
+    Returns the values of the auxiliary vector entries `types`, or None
+    if getauxval is not available (glibc < 2.16).
+    getauxval reads the auxiliary vector in memory, so this does not depend
+    on /proc/cpuinfo being readable.
+    """
+    try:
+        getauxval = ctypes.CDLL(None).getauxval
+    except (OSError, AttributeError):
+        return None
+    getauxval.restype = ctypes.c_ulong
+    getauxval.argtypes = [ctypes.c_ulong]
+    return [getauxval(t) for t in types]
 
-    Example:
-    >>> supported_instruction_sets()  # for x86
-    {"SSE2", "AVX2", "AVX512", ...}
-    >>> supported_instruction_sets()  # for PPC
-    {"VSX", "VSX2", ...}
-    >>> supported_instruction_sets()  # for ARM
-    {"NEON", "ASIMD", ...}
+
+def _linux_cpuinfo_flags(key):
+    """
+    Returns the upper-case flags listed on the first `key` line of
+    /proc/cpuinfo ("flags" on x86, "Features" on aarch64), or an empty set.
+    The file is searched as bytes: it has one block per core, and only a
+    single line of it is needed.
+    """
+    try:
+        with open("/proc/cpuinfo", "rb") as f:
+            data = b"\n" + f.read()
+    except OSError:
+        return set()
+    start = data.find(b"\n" + key.encode())
+    if start < 0:
+        return set()
+    end = data.find(b"\n", start + 1)
+    line = data[start:end if end >= 0 else len(data)]
+    _, _, flags = line.partition(b":")
+    return set(flags.decode("ascii", "replace").upper().split())
+
+
+def _darwin_sysctl_flags(names):
+    """
+    Returns the integer values of the sysctl entries `names`, 0 for the
+    entries that do not exist on this version of macOS.
+    """
+    try:
+        sysctlbyname = ctypes.CDLL(None).sysctlbyname
+    except (OSError, AttributeError):
+        return [0 for _ in names]
+    sysctlbyname.restype = ctypes.c_int
+    sysctlbyname.argtypes = [
+        ctypes.c_char_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t),
+        ctypes.c_void_p, ctypes.c_size_t,
+    ]
+    values = []
+    for name in names:
+        value = ctypes.c_int(0)
+        size = ctypes.c_size_t(ctypes.sizeof(value))
+        if sysctlbyname(name, ctypes.byref(value), ctypes.byref(size), None, 0) != 0:
+            value.value = 0
+        values.append(value.value)
+    return values
+
+
+@functools.lru_cache(maxsize=1)
+def aarch64_features():
     """
+    Returns the set of aarch64 extensions relevant to faiss that are
+    supported by the CPU and the OS, among ASIMD, ASIMDHP, ASIMDDP, SVE,
+    SVE2, I8MM and BF16. Returns an empty set on other architectures, or if
+    the features cannot be read.
+    """
+    machine = platform.machine()
+    if platform.system() == "Linux" and machine == "aarch64":
+        values = _linux_getauxval((_AT_HWCAP, _AT_HWCAP2))
+        if values is None:
+            # the kernel reports the same HWCAP bits with their lower-case
+            # names in /proc/cpuinfo
+            flags = _linux_cpuinfo_flags("Features")
+            return frozenset(name for name in _AARCH64_HWCAPS if name in flags)
+        auxv = dict(zip((_AT_HWCAP, _AT_HWCAP2), values))
+        return frozenset(
+            name for name, (at, bit) in _AARCH64_HWCAPS.items()
+            if auxv[at] & bit
+        )
+    if platform.system() == "Darwin" and machine == "arm64":
+        # Apple Silicon does not support SVE
+        names = list(_DARWIN_ARM_SYSCTLS)
+        values = _darwin_sysctl_flags([_DARWIN_ARM_SYSCTLS[n] for n in names])
+        return frozenset(n for n, v in zip(names, values) if v)
+    return frozenset()
+
+
+def is_sve_supported():
+    """
+    Returns True if the CPU and the kernel support the aarch64 Scalable
+    Vector Extension. SVE is only detected on Linux (Apple Silicon does not
+    support it).
+    """
+    return "SVE" in aarch64_features()
+
+
+def is_sve2_supported():
+    """
+    Returns True if the CPU and the kernel support SVE2, see
+    is_sve_supported().
+    """
+    return "SVE2" in aarch64_features()
+
+
+def _numpy_version_at_least(major, minor):
     import numpy
-    if Version(numpy.__version__) >= Version("1.19"):
+    version = tuple(int(v) for v in numpy.__version__.split(".")[:2])
+    return version >= (major, minor)
+
+
+def _detect_cpu_features():
+    # on x86-64, cpuid avoids importing numpy just to pick the SWIG module
+    features = cpuid.detect()
+    if features is not None:
+        return set(features)
+
+    # same on aarch64 with the HWCAP bits, they contain all the features
+    # that the aarch64 backends require
+    features = aarch64_features()
+    if features:
+        return set(features)
+
+    try:
+        numpy_1_19 = _numpy_version_at_least(1, 19)
+    except ImportError:
+        return set()
+
+    if numpy_1_19:
         # use private API as next-best thing until numpy/numpy#18058 is solved
         from numpy.core._multiarray_umath import __cpu_features__
         # __cpu_features__ is a dictionary with CPU features
         # as keys, and True / False as values
-        supported = {k for k, v in __cpu_features__.items() if v}
-        for f in os.getenv("FAISS_DISABLE_CPU_FEATURES", "").split(", \t\n\r"):
-            supported.discard(f)
-        return supported
+        return {k for k, v in __cpu_features__.items() if v}
 
     # platform-dependent legacy fallback before numpy 1.19, no windows
     if platform.system() == "Darwin":
-        if subprocess.check_output(["/usr/sbin/sysctl", "hw.optional.avx2_0"])[-1] == '1':
-            return {"AVX2"}
+        output = subprocess.check_output(["/usr/sbin/sysctl", "hw.optional.avx2_0"])
+        if output.strip()[-1:] == b"1":
+            # all the Macs with AVX2 also have FMA3, F16C and POPCNT
+            return set(_AVX2_FEATURES)
     elif platform.system() == "Linux":
-        import numpy.distutils.cpuinfo
-        result = set()
-        if "avx2" in numpy.distutils.cpuinfo.cpu.info[0].get('flags', ""):
-            result.add("AVX2")
-        if "avx512" in numpy.distutils.cpuinfo.cpu.info[0].get('flags', ""):
-            result.add("AVX512")
-        return result
+        # /proc/cpuinfo names FMA3 "fma"
+        flags = {
+            "FMA3" if f == "FMA" else f for f in _linux_cpuinfo_flags("flags")
+        }
+        return {f for f in flags if f in _AVX2_FEATURES + _AVX512_FEATURES}
     return set()
 
 
+def _parse_cpu_features(features):
+    """
+    Parses a list of CPU features separated by commas and/or whitespace,
+    as in FAISS_DISABLE_CPU_FEATURES="AVX2, AVX512F". Feature names are
+    case-insensitive, the result is upper-case.
+    """
+    return {f for f in re.split(r"[,\s]+", features.upper()) if f}
+
+
+@functools.lru_cache(maxsize=1)
+def supported_instruction_sets():
+    """
+    Returns the set of supported CPU features, see
+    https://github.com/numpy/numpy/blob/master/numpy/core/src/common/npy_cpu_features.h
+    for the list of features that this set may contain per architecture.
+    On x86-64 the features are read with cpuid (see cpuid.py), on aarch64
+    from the HWCAP bits (Linux) or sysctl (macOS), and numpy is only used
+    as a fallback, or on other architectures. The features listed in the
+    FAISS_DISABLE_CPU_FEATURES environment variable are removed.
+
+    The result is computed once and cached, so changes to
+    FAISS_DISABLE_CPU_FEATURES after the first call are not taken into
+    account. The returned set is a frozenset since it is shared between calls.
+
+    Example:
+    >>> supported_instruction_sets()  # for x86
+    {"SSE2", "AVX2", "FMA3", "AVX512F", "AVX512BW", ...}
+    >>> supported_instruction_sets()  # for PPC
+    {"VSX", "VSX2", ...}
+    >>> supported_instruction_sets()  # for ARM
+    {"ASIMD", "ASIMDHP", "ASIMDDP", "SVE", ...}
+    """
+    disabled = _parse_cpu_features(os.getenv("FAISS_DISABLE_CPU_FEATURES", ""))
+    return frozenset(_detect_cpu_features() - disabled)
+
+
+# the features enabled by the compile flags of faiss_avx2, and the ones that
+# faiss_avx512 adds
+_AVX2_FEATURES = ("AVX2", "FMA3", "F16C", "POPCNT")
+_AVX512_FEATURES = ("AVX512F", "AVX512CD", "AVX512VL", "AVX512DQ", "AVX512BW")
+
+# Optimized builds by decreasing order of optimization: value of
+# FAISS_OPT_LEVEL, SWIG module, and the CPU features it requires. The
+# features must match the compile flags of the corresponding faiss_* target
+# in faiss/CMakeLists.txt.
+_OPT_LEVEL_BACKENDS = [
+    # -march=sapphirerapids adds the Ice Lake extensions (VPOPCNTDQ,
+    # BITALG, VBMI, VBMI2, IFMA, VNNI), BF16 and FP16 to AVX512; the
+    # compiler emits them without intrinsics, e.g. vpopcntq in hamming.cpp.
+    # AVX512BF16 is reported by cpuid, not by numpy
+    ("AVX512_SPR", "swigfaiss_avx512_spr",
+     _AVX2_FEATURES + _AVX512_FEATURES +
+     ("AVX512VPOPCNTDQ", "AVX512BITALG", "AVX512VBMI", "AVX512VBMI2",
+      "AVX512IFMA", "AVX512VNNI", "AVX512BF16", "AVX512FP16")),
+    ("AVX512", "swigfaiss_avx512", _AVX2_FEATURES + _AVX512_FEATURES),
+    ("AVX2", "swigfaiss_avx2", _AVX2_FEATURES),
+    # x86-64-v2
+    ("SSE4", "swigfaiss_sse4", ("SSE3", "SSSE3", "SSE41", "SSE42", "POPCNT")),
+    ("SVE2", "swigfaiss_sve2", ("SVE", "SVE2")),
+    ("SVE", "swigfaiss_sve", ("SVE",)),
+    ("I8MM", "swigfaiss_i8mm", ("ASIMDHP", "ASIMDDP", "I8MM", "BF16")),
+    ("ASIMDDP", "swigfaiss_asimddp", ("ASIMDHP", "ASIMDDP")),
+    # there is no NEON level: NEON is part of the aarch64 baseline and the
+    # generic module already uses it (simdlib_neon.h)
+]
+
+# valid values of FAISS_OPT_LEVEL, an empty string is a synonym of GENERIC
+_OPT_LEVELS = ("GENERIC",) + tuple(level for level, _, _ in _OPT_LEVEL_BACKENDS)
+
+
+def _compatible_opt_levels(features):
+    """
+    Returns the optimization levels whose required CPU features are all in
+    `features`, by decreasing order of optimization. This is the only place
+    where the CPU features are matched against _OPT_LEVEL_BACKENDS.
+    """
+    return [
+        level for level, _, required in _OPT_LEVEL_BACKENDS
+        if all(f in features for f in required)
+    ]
+
+
 logger = logging.getLogger(__name__)
 
 instruction_sets = None
@@ -61,39 +284,154 @@ opt_level = os.environ.get(opt_env_variable_name, None)
 if opt_level is None:
     logger.debug(f"Environment variable {opt_env_variable_name} is not set, " \
                 "so let's pick the instruction set according to the current CPU")
-    instruction_sets = supported_instruction_sets()
+    instruction_sets = set(supported_instruction_sets())
+    opt_levels = _compatible_opt_levels(instruction_sets)
 else:
+    opt_level = opt_level.strip().upper()
+    if opt_level not in _OPT_LEVELS + ("",):
+        logger.warning(f"Unknown {opt_env_variable_name}={opt_level!r}, valid "
+                       f"values are {', '.join(_OPT_LEVELS)}. Loading generic faiss.")
     logger.debug(f"Using {opt_level} as an instruction set.")
     instruction_sets = set()
     instruction_sets.add(opt_level)
+    opt_levels = [opt_level]
 
-loaded = False
-has_AVX512 = any("AVX512" in x.upper() for x in instruction_sets)
-if has_AVX512:
+
+def _log_import_error(module_name, e):
+    logger.info(f"Could not load {module_name} due to:\n{e!r}\n"
+                f"CPU features: {' '.join(sorted(_supported))}. "
+                f"Set {opt_env_variable_name} to force another build, or "
+                f"recompile faiss with the matching -DFAISS_OPT_LEVEL.")
+
+
+has_AVX512_SPR = "AVX512_SPR" in opt_levels
+has_AVX512 = "AVX512" in opt_levels
+has_AVX2 = "AVX2" in opt_levels
+has_SSE4 = "SSE4" in opt_levels
+has_SVE2 = "SVE2" in opt_levels
+has_SVE = "SVE" in opt_levels
+has_I8MM = "I8MM" in opt_levels
+has_ASIMDDP = "ASIMDDP" in opt_levels
+
+# CPU features used by hashing code, independently of the optimization level
+# (only detected on x86-64 with cpuid). They describe the CPU, so they are
+# detected even when FAISS_OPT_LEVEL is set.
+_supported = supported_instruction_sets()
+has_SHA_NI = "SHA" in _supported
+has_AES = "AES" in _supported
+has_PCLMULQDQ = "PCLMULQDQ" in _supported
+has_VPCLMULQDQ = "VPCLMULQDQ" in _supported
+
+# The backend is chosen before anything is imported: these are the SWIG
+# modules to try, by decreasing order of optimization.
+_backend_candidates = [
+    (module_name, level) for level, module_name, _ in _OPT_LEVEL_BACKENDS
+    if level in opt_levels
+]
+
+
+def _prefetch_backend(module_name):
+    """
+    Asks the kernel to start reading the shared library of the SWIG module
+    into the page cache, so that the disk reads overlap with the Python
+    import machinery instead of blocking dlopen page by page. This matters
+    for cold starts, e.g. a container image that was just pulled.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    path = os.path.join(os.path.dirname(__file__), f"_{module_name}.so")
     try:
-        logger.info("Loading faiss with AVX512 support.")
-        from .swigfaiss_avx512 import *
-        logger.info("Successfully loaded faiss with AVX512 support.")
-        loaded = True
-    except ImportError as e:
-        logger.info(f"Could not load library with AVX512 support due to:\n{e!r}")
-        # reset so that we load without AVX512 below
-        loaded = False
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _import_backend(module_name):
+    """
+    Equivalent of `from .<module_name> import *`, so that the symbol X can
+    be accessed as faiss.X
+    """
+    _prefetch_backend(module_name)
+    module = importlib.import_module("." + module_name, __package__)
+    names = getattr(module, "__all__", None)
+    if names is None:
+        names = [k for k in module.__dict__ if not k.startswith("_")]
+    globals().update({k: getattr(module, k) for k in names})
+
 
-has_AVX2 = "AVX2" in instruction_sets
-if has_AVX2 and not loaded:
+def _shipped_backends():
+    """
+    Returns the (FAISS_OPT_LEVEL, SWIG module, required CPU features) of the
+    compiled modules that are installed next to this file.
+    """
+    dirname = os.path.dirname(__file__)
+    backends = [("GENERIC", "swigfaiss", ())] + _OPT_LEVEL_BACKENDS
+    return [
+        (level, module_name, features)
+        for level, module_name, features in backends
+        if any(os.path.exists(os.path.join(dirname, f"_{module_name}{ext}"))
+               for ext in (".so", ".pyd"))
+    ]
+
+
+def _no_backend_error(import_errors):
+    """
+    The error raised when no SWIG module could be loaded, `import_errors`
+    maps the modules that were tried to their ImportError. Lists these
+    errors, the installed modules with the CPU features they need that this
+    CPU lacks, and the values of FAISS_OPT_LEVEL that could work, i.e. the
+    installed modules that match the CPU and were not tried.
+    """
+    shipped = _shipped_backends()
+    missing = {
+        module_name: sorted(set(features) - _supported)
+        for _, module_name, features in shipped
+    }
+    usable = ["GENERIC"] + _compatible_opt_levels(_supported)
+    compatible = [
+        level for level, module_name, _ in shipped
+        if level in usable and module_name not in import_errors
+    ]
+    errors = "; ".join(
+        f"{module_name}: {e}" for module_name, e in import_errors.items())
+    if compatible:
+        hint = f"set {opt_env_variable_name} to one of {compatible} or reinstall"
+    else:
+        hint = "reinstall"
+    return ImportError(
+        f"faiss: could not load any compiled module ({errors}). "
+        f"CPU features missing per installed module: {missing}; "
+        f"{hint} faiss for this CPU."
+    )
+
+
+loaded = False
+_import_errors = {}
+for backend_name, _isa in _backend_candidates:
     try:
-        logger.info("Loading faiss with AVX2 support.")
-        from .swigfaiss_avx2 import *
-        logger.info("Successfully loaded faiss with AVX2 support.")
+        logger.info(f"Loading faiss with {_isa} support.")
+        _import_backend(backend_name)
+        logger.info(f"Successfully loaded faiss with {_isa} support.")
         loaded = True
+        break
     except ImportError as e:
-        logger.info(f"Could not load library with AVX2 support due to:\n{e!r}")
-        # reset so that we load without AVX2 below
-        loaded = False
+        _import_errors[backend_name] = e
+        _log_import_error(backend_name, e)
 
 if not loaded:
-    # we import * so that the symbol X can be accessed as faiss.X
+    backend_name = "swigfaiss"
     logger.info("Loading faiss.")
-    from .swigfaiss import *
+    try:
+        _import_backend(backend_name)
+    except ImportError as e:
+        _import_errors[backend_name] = e
+        raise _no_backend_error(_import_errors) from e
     logger.info("Successfully loaded faiss.")
+
+logger.debug(f"Loaded faiss compile options: {get_compile_options()}")
@@ -5,16 +5,26 @@
 
 from __future__ import print_function
 from setuptools import setup, find_packages
+from setuptools.command.build_ext import build_ext
+from setuptools.dist import Distribution
 import os
 import shutil
 import platform
+import subprocess
+import sys
 
 # make the faiss python package dir
 shutil.rmtree("faiss", ignore_errors=True)
 os.mkdir("faiss")
-shutil.copytree("contrib", "faiss/contrib")
+if os.path.isdir("contrib"):
+    shutil.copytree("contrib", "faiss/contrib")
+else:
+    # source tree, see CMakeBuild below
+    shutil.copytree(os.path.join("..", "..", "contrib"), "faiss/contrib",
+                    ignore=shutil.ignore_patterns("*.md", "__pycache__"))
 shutil.copyfile("__init__.py", "faiss/__init__.py")
 shutil.copyfile("loader.py", "faiss/loader.py")
+shutil.copyfile("cpuid.py", "faiss/cpuid.py")
 shutil.copyfile("class_wrappers.py", "faiss/class_wrappers.py")
 shutil.copyfile("gpu_wrappers.py", "faiss/gpu_wrappers.py")
 shutil.copyfile("extra_wrappers.py", "faiss/extra_wrappers.py")
@@ -23,32 +33,102 @@ shutil.copyfile("array_conversions.py", "faiss/array_conversions.py")
 ext = ".pyd" if platform.system() == 'Windows' else ".so"
 prefix = "Release/" * (platform.system() == 'Windows')
 
-swigfaiss_generic_lib = f"{prefix}_swigfaiss{ext}"
-swigfaiss_avx2_lib = f"{prefix}_swigfaiss_avx2{ext}"
-swigfaiss_avx512_lib = f"{prefix}_swigfaiss_avx512{ext}"
+# the SWIG modules that faiss/python/CMakeLists.txt can build, only the ones
+# that were actually compiled are packaged
+swigfaiss_modules = [
+    "swigfaiss",
+    "swigfaiss_sse4",
+    "swigfaiss_avx2",
+    "swigfaiss_avx512",
+    "swigfaiss_avx512_spr",
+    "swigfaiss_sve",
+    "swigfaiss_sve2",
+    "swigfaiss_i8mm",
+    "swigfaiss_asimddp",
+]
 
-found_swigfaiss_generic = os.path.exists(swigfaiss_generic_lib)
-found_swigfaiss_avx2 = os.path.exists(swigfaiss_avx2_lib)
-found_swigfaiss_avx512 = os.path.exists(swigfaiss_avx512_lib)
 
-assert (found_swigfaiss_generic or found_swigfaiss_avx2 or found_swigfaiss_avx512), \
-    f"Could not find {swigfaiss_generic_lib} or " \
-    f"{swigfaiss_avx2_lib} or {swigfaiss_avx512_lib}. Faiss may not be compiled yet."
+def find_swigfaiss_modules(dirname):
+    return [
+        module for module in swigfaiss_modules
+        if os.path.exists(os.path.join(dirname, f"{prefix}_{module}{ext}"))
+    ]
 
-if found_swigfaiss_generic:
-    print(f"Copying {swigfaiss_generic_lib}")
-    shutil.copyfile("swigfaiss.py", "faiss/swigfaiss.py")
-    shutil.copyfile(swigfaiss_generic_lib, f"faiss/_swigfaiss{ext}")
 
-if found_swigfaiss_avx2:
-    print(f"Copying {swigfaiss_avx2_lib}")
-    shutil.copyfile("swigfaiss_avx2.py", "faiss/swigfaiss_avx2.py")
-    shutil.copyfile(swigfaiss_avx2_lib, f"faiss/_swigfaiss_avx2{ext}")
+def copy_swigfaiss_modules(dirname, modules, dest):
+    for module in modules:
+        print(f"Copying {prefix}_{module}{ext}")
+        shutil.copyfile(os.path.join(dirname, f"{module}.py"),
+                        os.path.join(dest, f"{module}.py"))
+        shutil.copyfile(os.path.join(dirname, f"{prefix}_{module}{ext}"),
+                        os.path.join(dest, f"_{module}{ext}"))
+
+
+class CMakeBuild(build_ext):
+    """
+    Builds the SWIG modules with CMake, when setup.py is run from the faiss
+    source tree (`pip install --no-build-isolation faiss/python`) instead of
+    the CMake build directory. CMake, SWIG and numpy must already be
+    installed. The optimization level is read from FAISS_BUILD_OPT_LEVEL
+    (default: avx2 on x86-64, generic otherwise), and all the modules that
+    CMake builds for this level are packaged.
+    """
+
+    def run(self):
+        if shutil.which("cmake") is None:
+            raise RuntimeError("CMake is required to build faiss")
+        source_dir = os.path.abspath(os.path.join("..", ".."))
+        build_dir = os.path.abspath(os.path.join(self.build_temp, "cmake"))
+        default_opt_level = "avx2" if platform.machine().lower() in (
+            "x86_64", "amd64") else "generic"
+        opt_level = os.environ.get("FAISS_BUILD_OPT_LEVEL", default_opt_level)
+        subprocess.check_call([
+            "cmake", "-S", source_dir, "-B", build_dir,
+            f"-DFAISS_OPT_LEVEL={opt_level}",
+            # build for the interpreter that runs setup.py, not the first
+            # python on the PATH
+            f"-DPython_EXECUTABLE={sys.executable}",
+            "-DFAISS_ENABLE_GPU=OFF",
+            "-DBUILD_TESTING=OFF",
+            "-DCMAKE_BUILD_TYPE=Release",
+        ])
+        subprocess.check_call([
+            "cmake", "--build", build_dir, "--config", "Release",
+            "--parallel", str(os.cpu_count() or 1),
+        ])
+        python_dir = os.path.join(build_dir, "faiss", "python")
+        modules = find_swigfaiss_modules(python_dir)
+        assert modules, f"CMake did not build any SWIG module in {python_dir}"
+        dest = os.path.join(self.build_lib, "faiss")
+        os.makedirs(dest, exist_ok=True)
+        copy_swigfaiss_modules(python_dir, modules, dest)
+
+
+found_swigfaiss_modules = find_swigfaiss_modules(".")
+cmdclass = {}
+
+if found_swigfaiss_modules:
+    # run from the CMake build directory, after `make swigfaiss`
+    copy_swigfaiss_modules(".", found_swigfaiss_modules, "faiss")
+else:
+    assert os.path.exists("CMakeLists.txt"), \
+        f"Could not find any of " \
+        f"{', '.join(f'{prefix}_{module}{ext}' for module in swigfaiss_modules)}. " \
+        f"Faiss may not be compiled yet."
+    cmdclass["build_ext"] = CMakeBuild
+
+
+class BinaryDistribution(Distribution):
+    """
+    The SWIG modules are compiled by CMake, not by setuptools, so declare
+    that the package contains extension modules: the wheel then gets a
+    platform tag and is installed in platlib instead of being published as
+    a pure-python py3-none-any wheel.
+    """
+
+    def has_ext_modules(self):
+        return True
 
-if found_swigfaiss_avx512:
-    print(f"Copying {swigfaiss_avx512_lib}")
-    shutil.copyfile("swigfaiss_avx512.py", "faiss/swigfaiss_avx512.py")
-    shutil.copyfile(swigfaiss_avx512_lib, f"faiss/_swigfaiss_avx512{ext}")
 
 long_description="""
 Faiss is a library for efficient similarity search and clustering of dense
@@ -69,10 +149,12 @@ setup(
     license='MIT',
     keywords='search nearest neighbors',
 
-    install_requires=['numpy', 'packaging'],
+    install_requires=['numpy'],
     packages=['faiss', 'faiss.contrib'],
     package_data={
         'faiss': ['*.so', '*.pyd'],
     },
     zip_safe=False,
+    distclass=BinaryDistribution,
+    cmdclass=cmdclass,
 )
@@ -186,6 +186,7 @@ void fvec_inner_products_ny_ref(
  */
 
 FAISS_PRAGMA_IMPRECISE_FUNCTION_BEGIN
+FAISS_TARGET_CLONES
 float fvec_inner_product(const float* x, const float* y, size_t d) {
     float res = 0.F;
     FAISS_PRAGMA_IMPRECISE_LOOP
@@ -197,6 +198,7 @@ float fvec_inner_product(const float* x, const float* y, size_t d) {
 FAISS_PRAGMA_IMPRECISE_FUNCTION_END
 
 FAISS_PRAGMA_IMPRECISE_FUNCTION_BEGIN
+FAISS_TARGET_CLONES
 float fvec_norm_L2sqr(const float* x, size_t d) {
     // the double in the _ref is suspected to be a typo. Some of the manual
     // implementations this replaces used float.
@@ -211,6 +213,7 @@ float fvec_norm_L2sqr(const float* x, size_t d) {
 FAISS_PRAGMA_IMPRECISE_FUNCTION_END
 
 FAISS_PRAGMA_IMPRECISE_FUNCTION_BEGIN
+FAISS_TARGET_CLONES
 float fvec_L2sqr(const float* x, const float* y, size_t d) {
     size_t i;
     float res = 0;
@@ -226,6 +229,7 @@ FAISS_PRAGMA_IMPRECISE_FUNCTION_END
 /// Special version of inner product that computes 4 distances
 /// between x and yi
 FAISS_PRAGMA_IMPRECISE_FUNCTION_BEGIN
+FAISS_TARGET_CLONES
 void fvec_inner_product_batch_4(
         const float* __restrict x,
         const float* __restrict y0,
@@ -259,6 +263,7 @@ FAISS_PRAGMA_IMPRECISE_FUNCTION_END
 /// Special version of L2sqr that computes 4 distances
 /// between x and yi, which is performance oriented.
 FAISS_PRAGMA_IMPRECISE_FUNCTION_BEGIN
+FAISS_TARGET_CLONES
 void fvec_L2sqr_batch_4(
         const float* x,
         const float* y0,
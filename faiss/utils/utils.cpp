@@ -116,8 +116,18 @@ std::string get_compile_options() {
 
 #ifdef __AVX2__
     options += "AVX2 ";
+#ifdef __AVX512F__
+    options += "AVX512 ";
+#endif
+#ifdef __AVX512FP16__
+    options += "AVX512_SPR ";
+#endif
 #elif __AVX512F__
     options += "AVX512 ";
+#elif defined(__ARM_FEATURE_SVE)
+    options += "SVE NEON ";
+#elif defined(__SSE4_2__) && defined(__POPCNT__)
+    options += "SSE4 ";
 #elif defined(__aarch64__)
     options += "NEON ";
 #else
@@ -0,0 +1,179 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import platform
+import unittest
+
+import faiss
+from faiss import loader
+
+
+class TestCPUFeatures(unittest.TestCase):
+
+    def test_parse_cpu_features(self):
+        self.assertEqual(
+            loader._parse_cpu_features("AVX2,AVX512F"), {"AVX2", "AVX512F"})
+        self.assertEqual(
+            loader._parse_cpu_features(" avx2, \tSVE\n"), {"AVX2", "SVE"})
+        self.assertEqual(loader._parse_cpu_features(""), set())
+
+    @unittest.skipUnless(platform.system() == "Linux", "Linux only")
+    def test_cpuinfo_flags(self):
+        key = "Features" if platform.machine() == "aarch64" else "flags"
+        flags = loader._linux_cpuinfo_flags(key)
+        self.assertTrue(all(f == f.upper() for f in flags))
+        self.assertEqual(loader._linux_cpuinfo_flags("no such key"), set())
+
+    def test_supported_instruction_sets(self):
+        supported = loader.supported_instruction_sets()
+        self.assertIsInstance(supported, frozenset)
+        # cached
+        self.assertIs(supported, loader.supported_instruction_sets())
+
+    @unittest.skipUnless(platform.machine() in ("aarch64", "arm64"),
+                         "aarch64 only")
+    def test_aarch64_features(self):
+        features = loader.aarch64_features()
+        if not features:
+            self.skipTest("cannot read the HWCAP bits")
+        self.assertIn("ASIMD", features)
+        self.assertTrue(features <= loader._detect_cpu_features())
+
+    @unittest.skipUnless(platform.machine() in ("aarch64", "arm64"),
+                         "aarch64 only")
+    def test_aarch64_generic_uses_neon(self):
+        # all the aarch64 modules, including the generic one, use NEON
+        self.assertIn("NEON", faiss.get_compile_options().split())
+
+    def test_backend(self):
+        self.assertTrue(loader.backend_name.startswith("swigfaiss"))
+        self.assertIn(loader.backend_name,
+                      ["swigfaiss"] + [m for m, _ in loader._backend_candidates])
+        self.assertNotEqual(faiss.get_compile_options(), "")
+
+    def test_no_backend_error(self):
+        shipped = [m for _, m, _ in loader._shipped_backends()]
+        self.assertIn(loader.backend_name, shipped)
+        e = loader._no_backend_error({"swigfaiss": ImportError("test")})
+        self.assertIsInstance(e, ImportError)
+        self.assertIn("swigfaiss: test", str(e))
+        self.assertNotIn("'GENERIC'", str(e))
+        # FAISS_OPT_LEVEL is suggested only if a compatible module is left
+        usable = loader._compatible_opt_levels(loader._supported)
+        if any(level in usable for level, m, _ in loader._shipped_backends()
+               if m != "swigfaiss"):
+            self.assertIn(loader.opt_env_variable_name, str(e))
+        e = loader._no_backend_error(
+            {m: ImportError("test") for m in shipped})
+        self.assertNotIn(loader.opt_env_variable_name, str(e))
+
+
+class TestOptLevels(unittest.TestCase):
+    """ tier selection from made-up feature sets, independent of the host """
+
+    x86_v2 = {"SSE", "SSE2", "SSE3", "SSSE3", "SSE41", "SSE42", "POPCNT"}
+    x86_v3 = x86_v2 | {"AVX", "AVX2", "FMA3", "F16C"}
+    x86_v4 = x86_v3 | {"AVX512F", "AVX512CD", "AVX512VL", "AVX512DQ",
+                       "AVX512BW"}
+    x86_spr = x86_v4 | {"AVX512VPOPCNTDQ", "AVX512BITALG", "AVX512VBMI",
+                        "AVX512VBMI2", "AVX512IFMA", "AVX512VNNI",
+                        "AVX512BF16", "AVX512FP16"}
+
+    def test_x86(self):
+        self.assertEqual(loader._compatible_opt_levels(self.x86_v2), ["SSE4"])
+        self.assertEqual(
+            loader._compatible_opt_levels(self.x86_v3), ["AVX2", "SSE4"])
+        self.assertEqual(
+            loader._compatible_opt_levels(self.x86_v4),
+            ["AVX512", "AVX2", "SSE4"])
+        self.assertEqual(
+            loader._compatible_opt_levels(self.x86_spr),
+            ["AVX512_SPR", "AVX512", "AVX2", "SSE4"])
+
+    def test_x86_partial(self):
+        # no AVX512FP16: not a Sapphire Rapids
+        self.assertEqual(
+            loader._compatible_opt_levels(self.x86_spr - {"AVX512FP16"}),
+            ["AVX512", "AVX2", "SSE4"])
+        # -march=sapphirerapids emits vpopcntq, that a VM may hide
+        self.assertEqual(
+            loader._compatible_opt_levels(self.x86_spr - {"AVX512VPOPCNTDQ"}),
+            ["AVX512", "AVX2", "SSE4"])
+        # the AVX2 and AVX512 modules are compiled with -mfma
+        self.assertEqual(
+            loader._compatible_opt_levels(self.x86_v4 - {"FMA3"}), ["SSE4"])
+        self.assertEqual(loader._compatible_opt_levels({"AVX2"}), [])
+
+    def test_aarch64(self):
+        neoverse_v1 = {"ASIMD", "ASIMDHP", "ASIMDDP", "SVE", "I8MM", "BF16"}
+        self.assertEqual(
+            loader._compatible_opt_levels(neoverse_v1 | {"SVE2"}),
+            ["SVE2", "SVE", "I8MM", "ASIMDDP"])
+        self.assertEqual(
+            loader._compatible_opt_levels(neoverse_v1),
+            ["SVE", "I8MM", "ASIMDDP"])
+        # e.g. Apple M1: no SVE, I8MM and BF16
+        self.assertEqual(
+            loader._compatible_opt_levels({"ASIMD", "ASIMDHP", "ASIMDDP"}),
+            ["ASIMDDP"])
+        self.assertEqual(loader._compatible_opt_levels({"ASIMD"}), [])
+
+
+class TestCPUID(unittest.TestCase):
+
+    @unittest.skipUnless(faiss.cpuid.is_x86_64(), "x86-64 only")
+    def test_same_as_numpy(self):
+        detected = faiss.cpuid.detect()
+        if detected is None:
+            self.skipTest("cannot allocate executable memory")
+        from numpy.core._multiarray_umath import __cpu_features__
+        for feature in "SSE2", "SSE42", "POPCNT", "AVX2", "FMA3", \
+                "AVX512F", "AVX512CD", "AVX512VL", "AVX512DQ", "AVX512BW":
+            self.assertEqual(
+                feature in detected, __cpu_features__[feature], feature)
+
+    @unittest.skipUnless(faiss.cpuid.is_x86_64(), "x86-64 only")
+    def test_os_avx_state(self):
+        detected = faiss.cpuid.detect()
+        if detected is None:
+            self.skipTest("cannot allocate executable memory")
+        if "AVX2" in detected:
+            self.assertEqual(faiss.cpuid.xgetbv(0) & 0x6, 0x6)
+
+    @unittest.skipUnless(faiss.cpuid.is_x86_64() and
+                         platform.system() == "Linux", "x86-64 Linux only")
+    def test_same_as_cpuinfo(self):
+        detected = faiss.cpuid.detect()
+        if detected is None:
+            self.skipTest("cannot allocate executable memory")
+        flags = loader._linux_cpuinfo_flags("flags")
+        for feature, flag in ("AES", "AES"), ("PCLMULQDQ", "PCLMULQDQ"), \
+                ("SHA", "SHA_NI"):
+            self.assertEqual(feature in detected, flag in flags, feature)
+
+    def test_mask_os_state(self):
+        cpuid = faiss.cpuid
+        features = {"SSE42", "POPCNT", "AVX", "AVX2", "FMA3", "F16C",
+                    "VPCLMULQDQ", "AVX512F", "AVX512BW", "AVX512FP16"}
+        sse = {"SSE42", "POPCNT"}
+        avx = sse | {"AVX", "AVX2", "FMA3", "F16C", "VPCLMULQDQ"}
+        x87_sse = 0x3
+        # OS with AVX and AVX512 state
+        self.assertEqual(
+            cpuid._mask_os_state(features, True, 0xe7), features)
+        # no OSXSAVE: XCR0 cannot be read
+        self.assertEqual(cpuid._mask_os_state(features, False, 0xe7), sse)
+        # no YMM state
+        self.assertEqual(cpuid._mask_os_state(features, True, x87_sse), sse)
+        self.assertEqual(
+            cpuid._mask_os_state(features, True, x87_sse | 0xe0), sse)
+        # YMM but no opmask / ZMM state
+        self.assertEqual(cpuid._mask_os_state(features, True, 0x7), avx)
+        self.assertEqual(cpuid._mask_os_state(features, True, 0x67), avx)
+        # macOS: AVX512 state enabled lazily
+        self.assertEqual(
+            cpuid._mask_os_state(features, True, 0x7,
+                                 check_avx512_state=False),
+            features)